@@ -1,6 +1,12 @@
+import atexit
+import contextvars
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import re
+import socket
 import sys
 from typing import Any, List, Optional
 
@@ -13,12 +19,63 @@ logging.getLogger("peewee").setLevel(
     logging.INFO
 )  # Prevent debug messages from peewee lib
 
+# Per-event context (room and event ids) prepended to every record logged while
+# an event callback runs
+log_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default="")
+
+# Whether the DEBUG records of the current event are kept, decided once per event
+# so a sampled event keeps its whole trace. None outside of events, where each
+# record is sampled on its own
+debug_sampled: contextvars.ContextVar = contextvars.ContextVar("debug_sampled", default=None)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the current event context to records and samples DEBUG records.
+
+    Runs in the emitting thread, before the record is queued, so dropped DEBUG
+    records never get formatted.
+    """
+
+    def __init__(self, debug_sample_rate: float = 1.0):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def sample(self) -> bool:
+        """Decide whether to keep a DEBUG record, or the DEBUG records of an event"""
+        return self.debug_sample_rate >= 1.0 or random.random() < self.debug_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno == logging.DEBUG:
+            sampled = debug_sampled.get()
+            if not (self.sample() if sampled is None else sampled):
+                return False
+
+        context = log_context.get()
+        record.context = f"[{context}] " if context else ""
+        return True
+
+
+# The listener draining the log queue, there is only ever one per process
+_queue_listener: Optional[logging.handlers.QueueListener] = None
+_context_filter = ContextFilter()
+
+
+def set_debug_sample_rate(rate: float) -> None:
+    """Change the fraction of DEBUG records kept, between 0.0 and 1.0"""
+    _context_filter.debug_sample_rate = rate
+
+
+def sample_debug() -> bool:
+    """Decide whether the DEBUG records of a new event are kept"""
+    return _context_filter.sample()
+
 
 class Config:
     """Creates a Config object from a YAML-encoded config file from a given filepath"""
 
-    def __init__(self, filepath: str):
+    def __init__(self, filepath: str, configure_logging: bool = True):
         self.filepath = filepath
+        self.configure_logging = configure_logging
         if not os.path.isfile(filepath):
             raise ConfigError(f"Config file '{filepath}' does not exist")
 
@@ -32,31 +89,34 @@ class Config:
     def _parse_config_values(self):
         """Read and validate each config option"""
         # Logging setup
-        formatter = logging.Formatter(
-            "%(asctime)s | %(name)s [%(levelname)s] %(message)s"
+        self.log_level = self._get_cfg(["logging", "level"], default="INFO")
+        # Numeric levels are valid as is, names must be known to logging
+        if not isinstance(self.log_level, int) and not isinstance(
+            logging.getLevelName(self.log_level), int
+        ):
+            raise ConfigError(f"logging.level '{self.log_level}' is not a valid level")
+        self.debug_sample_rate = float(
+            self._get_cfg(
+                ["logging", "debug_sample_rate"], default=1.0, required=False
+            )
         )
+        if not 0.0 <= self.debug_sample_rate <= 1.0:
+            raise ConfigError("logging.debug_sample_rate must be between 0.0 and 1.0")
 
-        log_level = self._get_cfg(["logging", "level"], default="INFO")
-        logger.setLevel(log_level)
-
-        file_logging_enabled = self._get_cfg(
+        self.file_logging_enabled = self._get_cfg(
             ["logging", "file_logging", "enabled"], default=False
         )
-        file_logging_filepath = self._get_cfg(
+        self.file_logging_filepath = self._get_cfg(
             ["logging", "file_logging", "filepath"], default="bot.log"
         )
-        if file_logging_enabled:
-            handler = logging.FileHandler(file_logging_filepath)
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
-
-        console_logging_enabled = self._get_cfg(
+        self.console_logging_enabled = self._get_cfg(
             ["logging", "console_logging", "enabled"], default=True
         )
-        if console_logging_enabled:
-            handler = logging.StreamHandler(sys.stdout)
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
+
+        # A reloaded config only carries the new values, the handlers of the
+        # running process are left in place
+        if self.configure_logging:
+            self._setup_logging()
 
         # Storage setup
         self.store_path = self._get_cfg(["storage", "store_path"], required=True)
@@ -107,10 +167,92 @@ class Config:
         self.pics_path = self._get_cfg(["matrix", "pics_path"], required=True)
         self.log = self._get_cfg(["matrix", "log"], required=True)
         self.owners = self._get_cfg(["matrix", "owners"], required=True)
+        # Send room keys to devices nobody has verified, without it messages
+        # to encrypted rooms fail as soon as one member has an unverified device
+        self.ignore_unverified_devices = self._get_cfg(
+            ["matrix", "ignore_unverified_devices"], default=False, required=False
+        )
         self.event_time = self._get_cfg(["matrix", "event_time"], required=True)
+        match = re.fullmatch(r"(\d{1,2}):(\d{2})", str(self.event_time))
+        if not match or int(match[1]) > 23 or int(match[2]) > 59:
+            raise ConfigError("matrix.event_time must be in the form HH:MM")
+        self.event_hour, self.event_minute = int(match[1]), int(match[2])
+
+        # Image decoding limits, checked before any pixel data is decoded
+        self.max_image_pixels = int(
+            self._get_cfg(["images", "max_pixels"], default=40000000, required=False)
+        )
+        self.max_image_bytes = int(
+            self._get_cfg(["images", "max_bytes"], default=52428800, required=False)
+        )
+
+        # High availability setup
+        # Instances sharing storage.database elect a leader through a lease,
+        # each one needs its own matrix.device_id and storage.store_path
+        self.instance_id = self._get_cfg(
+            ["ha", "instance_id"],
+            default=f"{socket.gethostname()}-{os.getpid()}",
+            required=False,
+        )
+        self.lease_duration = float(
+            self._get_cfg(["ha", "lease_duration"], default=15, required=False)
+        )
+        if self.lease_duration <= 0:
+            raise ConfigError("ha.lease_duration must be a positive number of seconds")
 
         # self.command_prefix = self._get_cfg(["command_prefix"], default="!c") + " "
 
+    def _setup_logging(self):
+        """Route the root logger through a queue drained by a background thread.
+
+        The configured handlers are attached to the listener, the root logger
+        only gets a single queue handler. Calling this again replaces the
+        previous setup instead of stacking handlers.
+        """
+        global _queue_listener
+
+        formatter = logging.Formatter(
+            "%(asctime)s | %(name)s [%(levelname)s] %(context)s%(message)s"
+        )
+
+        logger.setLevel(self.log_level)
+        _context_filter.debug_sample_rate = self.debug_sample_rate
+
+        handlers = []
+
+        if self.file_logging_enabled:
+            handler = logging.FileHandler(self.file_logging_filepath)
+            handler.setFormatter(formatter)
+            handlers.append(handler)
+
+        if self.console_logging_enabled:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(formatter)
+            handlers.append(handler)
+
+        if _queue_listener is not None:
+            _queue_listener.stop()
+            atexit.unregister(_queue_listener.stop)
+            for handler in _queue_listener.handlers:
+                handler.close()
+        for handler in list(logger.handlers):
+            if isinstance(handler, logging.handlers.QueueHandler):
+                logger.removeHandler(handler)
+
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        # The records that pass the filter are formatted here, while their args
+        # still hold the state being logged; only the I/O is left to the thread
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(_context_filter)
+        logger.addHandler(queue_handler)
+
+        _queue_listener = logging.handlers.QueueListener(
+            log_queue, *handlers, respect_handler_level=True
+        )
+        _queue_listener.start()
+        # Flush what is still queued on shutdown
+        atexit.register(_queue_listener.stop)
+
     def _get_cfg(
         self,
         path: List[str],
@@ -139,4 +281,4 @@ class Config:
                 return default
 
         # We found the option. Return it.
-        return config
\ No newline at end of file
+        return config
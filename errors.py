@@ -9,4 +9,15 @@ class ConfigError(RuntimeError):
     """
 
     def __init__(self, msg: str):
-        super(ConfigError, self).__init__("%s" % (msg,))
\ No newline at end of file
+        super(ConfigError, self).__init__("%s" % (msg,))
+
+
+class ImageError(RuntimeError):
+    """An image that could not be decoded or is over the configured limits.
+
+    Args:
+        msg: The message displayed to the user on error.
+    """
+
+    def __init__(self, msg: str):
+        super(ImageError, self).__init__("%s" % (msg,))
@@ -0,0 +1,131 @@
+import io
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple, Union
+
+import imagehash
+from PIL import Image
+
+from errors import ImageError
+
+logger = logging.getLogger(__name__)
+
+# A path to an image file or its raw bytes
+ImageSource = Union[str, os.PathLike, bytes]
+
+
+class ImageDecoder:
+    """Decodes images with bounded memory and keeps per-operation accounting.
+
+    Every Pillow decode of the bot goes through here. Byte and pixel limits are
+    checked from the file size and the image header, before any pixel data is
+    decoded, and files are always closed once the operation is done.
+    """
+
+    def __init__(self, max_pixels: int, max_bytes: int):
+        """
+        Args:
+            max_pixels: The largest width * height accepted.
+            max_bytes: The largest encoded file size accepted.
+        """
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def probe(self, source: ImageSource) -> Tuple[int, int]:
+        """Get the width and height of an image from its header only"""
+        with self._open("probe", source) as im:
+            return im.size
+
+    def average_hash(self, source: ImageSource, hash_size: int = 8) -> imagehash.ImageHash:
+        """Hash an image, decoding it at a reduced scale where the format allows.
+
+        Draft mode lets JPEGs decode straight to a fraction of their size, which
+        is plenty for a hash that ends up as hash_size x hash_size.
+        """
+        with self._open("hash", source) as im:
+            im.draft("L", (hash_size * 8, hash_size * 8))
+            try:
+                im.load()
+            except OSError as e:
+                raise ImageError(f"Unable to decode image: {e}")
+            self._record_decoded("hash", im)
+            return imagehash.average_hash(im, hash_size=hash_size)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Get a copy of the accounting of each operation.
+
+        Returns:
+            A dictionary keyed by operation, each holding the number of calls,
+            rejected images, and total and max seconds. Operations that decode
+            pixels also hold max_decoded_bytes_estimate, the largest
+            width * height * bands decoded, an estimate of Pillow's buffer.
+        """
+        return {op: dict(values) for op, values in self._stats.items()}
+
+    @contextmanager
+    def _open(self, op: str, source: ImageSource) -> Iterator[Image.Image]:
+        """Open an image lazily after checking it against the limits.
+
+        Raises:
+            ImageError: If the image is over a limit or can't be identified.
+        """
+        stats = self._stats.setdefault(
+            op,
+            {"count": 0, "rejected": 0, "total_time": 0.0, "max_time": 0.0},
+        )
+        stats["count"] += 1
+        start = time.perf_counter()
+        try:
+            if isinstance(source, bytes):
+                size = len(source)
+                stream = io.BytesIO(source)
+            else:
+                size = os.stat(source).st_size
+                stream = open(source, "rb")
+
+            with stream:
+                if size > self.max_bytes:
+                    raise ImageError(f"Image is {size} bytes, the limit is {self.max_bytes}")
+
+                try:
+                    im = Image.open(stream)
+                except (Image.DecompressionBombError, OSError) as e:
+                    raise ImageError(f"Unable to open image: {e}")
+
+                with im:
+                    width, height = im.size
+                    if width * height > self.max_pixels:
+                        raise ImageError(
+                            f"Image is {width}x{height}, the limit is {self.max_pixels} pixels"
+                        )
+                    yield im
+        except ImageError:
+            stats["rejected"] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+            logger.debug("%s of %s took %.3fs", op, _describe(source), elapsed)
+
+    def _record_decoded(self, op: str, im: Image.Image) -> None:
+        """Estimate the pixel buffer Pillow allocated for a decode.
+
+        Pillow allocates outside the Python heap, so this is width * height *
+        bands of the decoded image rather than a measured peak.
+        """
+        width, height = im.size
+        decoded_bytes = width * height * len(im.getbands())
+        stats = self._stats[op]
+        stats["max_decoded_bytes_estimate"] = max(
+            stats.get("max_decoded_bytes_estimate", 0), decoded_bytes
+        )
+
+
+def _describe(source: ImageSource) -> str:
+    if isinstance(source, bytes):
+        return f"{len(source)} bytes"
+    return str(source)
@@ -2,7 +2,8 @@
 
 import os
 import sys
-import io
+import signal
+import functools
 
 from urllib.parse import urlparse
 
@@ -11,14 +12,13 @@ import magic
 import time
 import asyncio
 import aiofiles.os
-import imagehash
 
 from pprint import pprint
+from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from pathlib import Path
-from PIL import Image
 from random import randint
-from aiohttp import ClientConnectionError, ServerDisconnectedError
+from aiohttp import ClientConnectionError, ClientError, ServerDisconnectedError
 
 from nio import (AsyncClient,
                  AsyncClientConfig,
@@ -35,24 +35,57 @@ from nio import (AsyncClient,
                  Event,
                  UnknownEvent,
                  HttpClient,
-                 DownloadResponse,
                  LoginResponse,
-                 ReactionEvent)
+                 ReactionEvent,
+                 EncryptionError)
 
 from storage import Storage
-from config import Config
+from config import Config, debug_sampled, log_context, sample_debug, set_debug_sample_rate
+from errors import ImageError
+from images import ImageDecoder
 
 import logging
-from logging import Formatter
 
-TERM_FORMAT = '[%(name)s][%(levelname)s]  %(message)s (%(filename)s:%(lineno)d)'
-FILE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+from nio.api import Api
+from nio.crypto import decrypt_attachment
+
+
+def safe_filename(*names):
+    """Get the base name of the first usable name, None if there is none.
+
+    The names come from whoever posted the image, so any directory part is
+    dropped to keep writes inside pics_path.
+    """
+    for name in names:
+        name = os.path.basename(name or "")
+        if name not in ("", ".", "..") and "\0" not in name:
+            return name
+    return None
+
+
+def event_context(callback):
+    """Tag every record logged by an event callback with its room and event ids,
+    and sample its DEBUG records as a whole"""
+    @functools.wraps(callback)
+    async def wrapper(self, room, event):
+        room_id = getattr(room, "room_id", room)
+        token = log_context.set(f"{room_id} {getattr(event, 'event_id', '-')}")
+        # Sample DEBUG once per event, so a kept event keeps its whole trace
+        sampled_token = debug_sampled.set(sample_debug())
+        try:
+            return await callback(self, room, event)
+        finally:
+            debug_sampled.reset(sampled_token)
+            log_context.reset(token)
+    return wrapper
+
 
 class LainBot:
     _initial_sync_done = False
 
     def __init__(self, config_path):
 
+        self.config_path = config_path
         self.client_config = None
         self.config = None
         self.loop = asyncio.get_event_loop()
@@ -67,15 +100,11 @@ class LainBot:
         # Configure the database
         self.store = Storage(self.config.database)
 
-        self.logger = logging.getLogger("LainBot")
-
-        # Add console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
-        console_format = Formatter(TERM_FORMAT)
-        console_handler.setFormatter(console_format)
-        self.logger.addHandler(console_handler)
+        # All image decoding goes through here, bounded by the configured limits
+        self.decoder = ImageDecoder(self.config.max_image_pixels, self.config.max_image_bytes)
 
+        # Records propagate to the handlers set up by Config
+        self.logger = logging.getLogger("LainBot")
 
         self.logger.info("Initializing system.")
 
@@ -90,14 +119,130 @@ class LainBot:
         self.room_id = self.config.room_id
         self.path = self.config.pics_path
         self.event_time = self.config.event_time
+        self.ignore_unverified_devices = self.config.ignore_unverified_devices
 
         self.client = None
         self.http_client = None
         self.users = list()
-        self.hours, self.minutes =  self.event_time.split(':')
-        self.scheduler.add_job(self.job, 'cron', day_of_week='mon-sun', hour=self.hours, minute=self.minutes)
+        self.hours, self.minutes = self.config.event_hour, self.config.event_minute
+        self.cron_job = self.scheduler.add_job(self.job, 'cron', day_of_week='mon-sun', hour=self.hours, minute=self.minutes)
+
+        # Only the instance holding the leader lease acts, the others keep
+        # syncing so they are ready to take over
+        self.instance_id = self.config.instance_id
+        self.lease_duration = self.config.lease_duration
+        self.lease_expires_at = 0
+        self.takeover_latency = None
+        self.job_lock = asyncio.Lock()
+        self.catch_up_task = None
+        self.scheduler.add_job(self.renew_lease, 'interval', seconds=self.lease_duration / 3,
+                               next_run_time=datetime.now())
         self.scheduler.start()
 
+    def reload_config(self):
+        """Re-read the config file and apply the changed values in place.
+
+        The client, its store and the sync loop are kept, so no event is lost
+        to a new initial sync. Options tied to the client or the database are
+        only picked up on restart.
+        """
+        self.logger.info(f"Reloading config from {self.config_path}")
+        try:
+            # Every value is parsed and validated here, before anything is applied
+            new_config = Config(self.config_path, configure_logging=False)
+        except Exception as e:
+            self.logger.error(f"Config reload failed, keeping the current one: {e}")
+            return
+
+        if new_config.log_level != self.config.log_level:
+            logging.getLogger().setLevel(new_config.log_level)
+            self.logger.info(f"Log level set to {new_config.log_level}")
+
+        if new_config.debug_sample_rate != self.config.debug_sample_rate:
+            set_debug_sample_rate(new_config.debug_sample_rate)
+            self.logger.info(f"Debug sample rate set to {new_config.debug_sample_rate}")
+
+        if new_config.owners != self.bot_owners:
+            self.bot_owners = new_config.owners
+            self.logger.info(f"Owners set to {self.bot_owners}")
+
+        if new_config.pics_path != self.path:
+            self.path = new_config.pics_path
+            self.logger.info(f"Pics path set to {self.path}")
+
+        if new_config.ignore_unverified_devices != self.ignore_unverified_devices:
+            self.ignore_unverified_devices = new_config.ignore_unverified_devices
+            self.logger.info(f"Ignore unverified devices set to {self.ignore_unverified_devices}")
+
+        if new_config.event_time != self.event_time:
+            self.event_time = new_config.event_time
+            self.hours, self.minutes = new_config.event_hour, new_config.event_minute
+            self.cron_job.reschedule('cron', day_of_week='mon-sun', hour=self.hours, minute=self.minutes)
+            self.logger.info(f"Job rescheduled at {self.event_time}")
+
+        if (new_config.max_image_pixels, new_config.max_image_bytes) != (self.decoder.max_pixels,
+                                                                          self.decoder.max_bytes):
+            self.decoder.max_pixels = new_config.max_image_pixels
+            self.decoder.max_bytes = new_config.max_image_bytes
+            self.logger.info(f"Image limits set to {self.decoder.max_pixels} pixels, "
+                             f"{self.decoder.max_bytes} bytes")
+
+        for option in ("homeserver_url", "user_id", "user_token", "user_password",
+                       "device_id", "store_path", "database", "room_id",
+                       "instance_id", "lease_duration", "file_logging_enabled",
+                       "file_logging_filepath", "console_logging_enabled"):
+            if getattr(new_config, option) != getattr(self.config, option):
+                self.logger.warning(f"Config option {option} changed, restart to apply it")
+
+        self.config = new_config
+
+    async def renew_lease(self):
+        """Take or renew the leader lease, stepping down if it can't be renewed.
+
+        Runs on the event loop like the callbacks, so leadership never changes
+        halfway through one of them.
+        """
+        # The database decides expiry by its own clock. Locally the lease is only
+        # trusted for its duration from before the request was sent, which ends
+        # no later than the database's expiry
+        started = time.monotonic()
+        was_leader = self.is_leader
+        try:
+            holder, last_renewed_at = self.store.get_lease()
+            acquired = self.store.acquire_lease(self.instance_id, self.lease_duration)
+            if acquired and not was_leader:
+                _, renewed_at = self.store.get_lease()
+        except Exception as e:
+            self.logger.error(f"Unable to renew the leader lease: {e}")
+            acquired = False
+
+        # Step down on any failure, a standby may already be taking over
+        self.lease_expires_at = started + self.lease_duration if acquired else 0
+
+        if acquired and not was_leader:
+            if holder is not None and last_renewed_at is not None:
+                # Time since the previous leader last renewed or released the lease
+                self.takeover_latency = renewed_at - last_renewed_at
+                self.logger.warning(f"Took over as leader from {holder} "
+                                    f"after {self.takeover_latency:.1f}s")
+            else:
+                self.logger.info(f"Instance {self.instance_id} is the leader")
+            # In its own task, so a long post doesn't hold up the next renewal
+            self.schedule_catch_up()
+        elif not acquired and was_leader:
+            self.logger.warning(f"Instance {self.instance_id} lost the leader lease, standing by")
+
+    @property
+    def is_leader(self):
+        # Checked against the local clock too, so a leader whose loop stalled
+        # past the lease stops acting before it notices it was replaced
+        return time.monotonic() < self.lease_expires_at
+
+    def release_lease(self):
+        if self.is_leader:
+            self.lease_expires_at = 0
+            self.store.release_lease(self.instance_id)
+            self.logger.info("Leader lease released")
 
     async def on_error(self, response):
         self.logger.error(response)
@@ -112,6 +257,7 @@ class LainBot:
             for room in self.client.rooms:
                 self.logger.info('room %s', room)
             self.logger.info('initial sync done, ready for work')
+            self.schedule_catch_up()
 
     async def start(self):
 
@@ -140,6 +286,12 @@ class LainBot:
         self.client.add_event_callback(self.on_reaction, ReactionEvent)
         self.client.add_event_callback(self.on_image, RoomMessageImage)
 
+        loop = asyncio.get_running_loop()
+        # Reload the config on SIGHUP without dropping the sync session
+        loop.add_signal_handler(signal.SIGHUP, self.reload_config)
+        # Unwind through the finally blocks on SIGTERM, so the lease is released
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
         self.logger.info("Starting initial sync")
         # Keep trying to reconnect on failure (with some time in-between)
         while True:
@@ -170,7 +322,56 @@ class LainBot:
             self.scheduler.run_pending()
             await asyncio.sleep(1)
 
+    def previous_fire_time(self):
+        """The unix timestamp of the latest scheduled time of the daily job"""
+        now = datetime.now()
+        fire = now.replace(hour=self.hours, minute=self.minutes, second=0, microsecond=0)
+        if fire > now:
+            fire -= timedelta(days=1)
+        return fire.timestamp()
+
+    def schedule_catch_up(self):
+        """Run catch_up_job in its own task, off the sync and lease callbacks"""
+        self.catch_up_task = asyncio.ensure_future(self.catch_up_job())
+        self.catch_up_task.add_done_callback(self.on_catch_up_done)
+
+    def on_catch_up_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error("Catch-up job failed", exc_info=task.exception())
+
+    async def catch_up_job(self):
+        """Run the daily job if its last scheduled time passed without a run.
+
+        Covers a leader that died or handed over just before the job fired,
+        while the standbys didn't hold the lease yet.
+        """
+        if not self.is_leader or not self._initial_sync_done:
+            return
+        last_run = self.store.get_last_run("job")
+        if last_run is not None and last_run < self.previous_fire_time():
+            self.logger.warning("The last scheduled job was missed, running it now")
+            await self.job()
+
     async def job(self):
+        # A standby may find the lease expired right at the scheduled time
+        if not self.is_leader:
+            await self.renew_lease()
+        if not self.is_leader:
+            return
+        # Room encryption is only known once synced, catch_up_job runs it then
+        if not self._initial_sync_done:
+            self.logger.info("Job postponed until the initial sync is done")
+            return
+
+        async with self.job_lock:
+            fired_at = self.previous_fire_time()
+            last_run = self.store.get_last_run("job")
+            if last_run is not None and last_run >= fired_at:
+                return
+            await self.run_job()
+            self.store.record_run("job", fired_at)
+
+    async def run_job(self):
         self.logger.info("Job started")
         pic_list = os.listdir(self.path)
         pic_num = randint(a=0, b=len(pic_list) - 1)
@@ -218,22 +419,44 @@ class LainBot:
             self.logger.warning("Drop message because file does not have an image mime type.")
             return
 
-        im = Image.open(image)
-        (width, height) = im.size  # im.size returns (width,height) tuple
+        try:
+            (width, height) = self.decoder.probe(image)
+        except ImageError as e:
+            self.logger.warning(f"Drop image {image}: {e}")
+            return
 
         # first do an upload of image, then send URI of upload to room
         file_stat = await aiofiles.os.stat(image)
-        async with aiofiles.open(image, "r+b") as f:
-            resp, maybe_keys = await self.client.upload(
-                f,
-                content_type=mime_type,  # image/jpeg
-                filename=os.path.basename(image),
-                filesize=file_stat.st_size)
-        if isinstance(resp, UploadResponse):
-            self.logger.info("Image was uploaded successfully to server. ")
-        else:
-            self.logger.warning(f"Failed to upload image. Failure response: {resp}")
+        # Fail closed, a room we haven't synced yet may well be encrypted
+        if room not in self.client.rooms:
+            self.logger.warning(f"Drop image {image}: room {room} is not known yet")
             return
+        encrypted = self.client.rooms[room].encrypted
+
+        # Reuse an earlier upload of the same file, encrypted ones keep their keys
+        cached = self.store.get_cached_upload(image, encrypted, file_stat.st_mtime, file_stat.st_size)
+        if cached:
+            content_uri, file_keys = cached
+            self.logger.info("Image was already uploaded, reusing it.")
+        else:
+            # With encrypt, nio encrypts the file chunk by chunk as it streams it
+            # and returns the keys for the `file` object
+            async with aiofiles.open(image, "r+b") as f:
+                resp, file_keys = await self.client.upload(
+                    f,
+                    content_type="application/octet-stream" if encrypted else mime_type,
+                    filename=os.path.basename(image),
+                    encrypt=encrypted,
+                    filesize=file_stat.st_size)
+            if isinstance(resp, UploadResponse):
+                self.logger.info("Image was uploaded successfully to server. ")
+            else:
+                self.logger.warning(f"Failed to upload image. Failure response: {resp}")
+                return
+
+            content_uri = resp.content_uri
+            self.store.store_cached_upload(image, encrypted, file_stat.st_mtime, file_stat.st_size,
+                                           content_uri, file_keys)
 
         content = {
             "body": os.path.basename(image),  # descriptive title
@@ -246,22 +469,27 @@ class LainBot:
                 "thumbnail_url": None,  # TODO
             },
             "msgtype": "m.image",
-            "url": resp.content_uri,
         }
+        if encrypted:
+            content["file"] = {"url": content_uri, "mimetype": mime_type, **file_keys}
+        else:
+            content["url"] = content_uri
 
         try:
             await self.client.room_send(
                 room,
                 message_type="m.room.message",
-                content=content
+                content=content,
+                ignore_unverified_devices=self.ignore_unverified_devices
             )
             self.logger.info("Image was sent successfully")
         except Exception as e:
             self.logger.debug(e)
             self.logger.info(f"Image send of file {image} failed.")
 
+    @event_context
     async def on_message(self, room, event):
-        if not self._initial_sync_done:
+        if not self._initial_sync_done or not self.is_leader:
             return
                 
         room_id = room.room_id 
@@ -276,7 +504,7 @@ class LainBot:
             if msg[1:] == "pic":
                 if event.sender in self.users:
                     return
-                self.logger.debug("picture for {0}: {1}".format(event.sender, event.body))
+                self.logger.debug("picture for %s: %s", event.sender, event.body)
                 if event.sender not in self.bot_owners:
                     self.users.append(event.sender)
                 pic_list = os.listdir(self.path)
@@ -297,27 +525,25 @@ class LainBot:
 
         return
 
+    @event_context
     async def on_image(self, room_id, event):
         if not self._initial_sync_done:
             return
         self.logger.info(f"Image received in room {room_id}")
 
+    @event_context
     async def on_reaction(self, room, event):
-        if not self._initial_sync_done:
+        if not self._initial_sync_done or not self.is_leader:
             return
         
         room_id = room.room_id
         
-        self.logger.debug(f"room_id = {room_id}")
-        self.logger.debug(f"event = {event}")
+        self.logger.debug("event = %s", event)
 
         if isinstance(event, ReactionEvent):
             if event.key == '👍️':
-                self.logger.debug("EVENT KEY")
-                self.logger.debug(f"User {event.sender} Key {event.source['content']['m.relates_to']['key']}")
                 message_event_id = event.source['content']['m.relates_to']['event_id']
-                event_id = event.source['event_id']
-                self.logger.debug(f"Event ID: {event_id} - Reaction ID {message_event_id}")
+                self.logger.debug("User %s Key %s - Reaction to %s", event.sender, event.key, message_event_id)
                 msg = await self.client.room_get_event(room_id=room_id, event_id=message_event_id)
 
                 # self.logger.debug("MSG")
@@ -326,50 +552,79 @@ class LainBot:
                 # self.logger.debug("MSG Transport")
                 # self.logger.debug(msg.transport_response)
 
-                self.logger.debug("Client Response")
-
                 json_data = await self.client.parse_body(msg.transport_response)
 
-                self.logger.debug("JSON Response")
-                self.logger.debug(json_data)
+                self.logger.debug("JSON Response %s", json_data)
 
-                self.logger.debug("Response Type")
-                self.logger.debug(json_data.get('type'))
+                if json_data.get('type') == 'm.room.encrypted':
+                    # Messages of encrypted rooms come back as megolm events
+                    try:
+                        json_data = self.client.decrypt_event(msg.event).source
+                    except EncryptionError as e:
+                        self.logger.warning(f"Unable to decrypt event {message_event_id}: {e}")
+                        return
 
                 if json_data.get('type') == 'm.room.message':
                     sender = event.sender
 
-                    self.logger.debug(sender)
-
                     if sender not in self.bot_owners:
                         return
 
                     content = json_data.get('content')
 
-                    self.logger.debug(content.get('msgtype'))
-
                     if content.get('msgtype') == 'm.image':
-                        mxc = content.get('url')
-                        server_name = urlparse(mxc).netloc
-                        media_id = os.path.basename(urlparse(mxc).path)
+                        # Encrypted attachments come as a file object holding the keys
+                        file_info = content.get('file')
+                        if file_info:
+                            try:
+                                mxc = file_info['url']
+                                key = file_info['key']['k']
+                                sha256 = file_info['hashes']['sha256']
+                                iv = file_info['iv']
+                            except (KeyError, TypeError):
+                                self.logger.warning(f"Refusing image {message_event_id}: malformed file object")
+                                return
+                        else:
+                            mxc = content.get('url')
+                        if not isinstance(mxc, str):
+                            self.logger.warning(f"Refusing image {message_event_id}: no media url")
+                            return
 
-                        self.logger.debug(f"MXC = {mxc}")
-                        self.logger.debug(f"Server = {server_name}")
-                        self.logger.debug(f"Media ID = {media_id}")
+                        self.logger.debug("MXC = %s", mxc)
 
-                        # try:
+                        # Refuse what the sender already declares too large before
+                        # downloading anything
+                        size = (content.get('info') or {}).get('size')
+                        if isinstance(size, int) and size > self.decoder.max_bytes:
+                            self.logger.warning(f"Refusing image {mxc}: {size} bytes, "
+                                                f"the limit is {self.decoder.max_bytes}")
+                            return
 
-                        image = await self.client.download(server_name=server_name, media_id=media_id, filename=None, allow_remote=True)
-                        assert isinstance(image, DownloadResponse)
+                        image = await self.download_media(mxc, self.decoder.max_bytes)
+                        if image is None:
+                            return
+                        body, download_filename = image
 
-                        filename = image.filename
-                        body = image.body
-                        self.logger.debug(f"filename = {filename}")
+                        filename = safe_filename(download_filename, content.get('body'))
+                        if filename is None:
+                            self.logger.warning(f"Refusing image {mxc}: no usable file name")
+                            return
 
+                        if file_info:
+                            try:
+                                body = await asyncio.get_running_loop().run_in_executor(
+                                    None, decrypt_attachment, body, key, sha256, iv)
+                            except EncryptionError as e:
+                                self.logger.warning(f"Unable to decrypt image {mxc}: {e}")
+                                return
+                        self.logger.debug("filename = %s", filename)
 
-                        imageStream = io.BytesIO(body)
-                        imageFile = Image.open(imageStream)
-                        new_hash = imagehash.average_hash(imageFile)
+
+                        try:
+                            new_hash = self.decoder.average_hash(body)
+                        except ImageError as e:
+                            self.logger.warning(f"Refusing image {mxc}: {e}")
+                            return
 
                         # self.logger.debug(hash)
                         # self.logger.debug("IMAGES")
@@ -378,8 +633,12 @@ class LainBot:
                         image_duped = False
 
                         for image in  self.get_stored_images():
-                            print(image)
-                            stored_hash = imagehash.average_hash(Image.open(image))
+                            self.logger.debug("Comparing with %s", image)
+                            try:
+                                stored_hash = self.decoder.average_hash(image)
+                            except ImageError as e:
+                                self.logger.warning(f"Skipping stored image {image}: {e}")
+                                continue
                             if stored_hash == new_hash:
                                 self.logger.debug("Image found in db")
                                 image_duped = True
@@ -398,7 +657,8 @@ class LainBot:
                                                 "event_id": message_event_id
                                             }
                                         }
-                                    }
+                                    },
+                                    ignore_unverified_devices=self.ignore_unverified_devices
                                 )
 
                                 await self.client.room_typing(room_id, False)
@@ -435,12 +695,14 @@ class LainBot:
                                         "event_id": message_event_id
                                     }
                                 }
-                            }
+                            },
+                            ignore_unverified_devices=self.ignore_unverified_devices
                         )
 
                         await self.client.room_typing(room_id, False)
 
                         self.logger.debug("Image download success")
+                        self.logger.debug("Image decoding stats %s", self.decoder.stats())
 
                         # except Exception as e:
                         #     self.logger.error(e)
@@ -451,6 +713,51 @@ class LainBot:
                 # if message_content.type == 'm.room.message':
                 #     self.logger.debug("GOT Image")
                 #     self.logger.debug(message_content.url)
+    async def download_media(self, mxc, max_bytes):
+        """Download media, refusing anything over max_bytes.
+
+        The length is checked from the headers and again while reading, so an
+        oversized response is dropped without ever being buffered whole.
+
+        Returns:
+            The body and the file name given by the server (possibly None), or
+            None if the download failed or was refused.
+        """
+        url = urlparse(mxc)
+        method, path = Api.download(url.netloc, os.path.basename(url.path), allow_remote=True)
+        try:
+            resp = await self.client.send(
+                method, path, headers={"Authorization": f"Bearer {self.client.access_token}"})
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning(f"Unable to download {mxc}: {e}")
+            return None
+
+        # Errors while streaming the body must not escape into the sync loop
+        try:
+            if resp.status != 200:
+                self.logger.warning(f"Unable to download {mxc}: HTTP {resp.status}")
+                return None
+            if resp.content_length is not None and resp.content_length > max_bytes:
+                self.logger.warning(f"Refusing {mxc}: {resp.content_length} bytes, the limit is {max_bytes}")
+                return None
+
+            chunks = []
+            received = 0
+            async for chunk in resp.content.iter_chunked(65536):
+                received += len(chunk)
+                if received > max_bytes:
+                    self.logger.warning(f"Refusing {mxc}: over the limit of {max_bytes} bytes")
+                    return None
+                chunks.append(chunk)
+
+            disposition = resp.content_disposition
+            return b"".join(chunks), disposition.filename if disposition else None
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.logger.warning(f"Unable to download {mxc}: {e}")
+            return None
+        finally:
+            resp.release()
+
     def get_stored_images(self):
 
         images = Path(self.path).iterdir()
@@ -465,8 +772,14 @@ async def main(argv) -> None:
         sys.exit(1)
 
     bot = LainBot(config_path)
-    
-    await bot.start()
+
+    try:
+        await bot.start()
+    except asyncio.CancelledError:
+        bot.logger.info("Shutting down")
+    finally:
+        # Let a standby take over without waiting for the lease to expire
+        bot.release_lease()
 
 
 if __name__ == '__main__':
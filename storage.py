@@ -1,5 +1,7 @@
+import json
 import logging
-from typing import Any, Dict
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
 
 # The latest migration version of the database.
 #
@@ -8,7 +10,10 @@ from typing import Any, Dict
 # the version specified here.
 #
 # When a migration is performed, the `migration_version` table should be incremented.
-latest_migration_version = 0
+latest_migration_version = 4
+
+# Key of the Postgres advisory lock serialising setup and migrations
+migration_lock_id = 0x4C61696E
 
 logger = logging.getLogger(__name__)
 
@@ -32,17 +37,20 @@ class Storage:
         self.cursor = self.conn.cursor()
         self.db_type = database_config["type"]
 
-        # Try to check the current migration version
-        migration_level = 0
-        try:
-            self._execute("SELECT version FROM migration_version")
-            row = self.cursor.fetchone()
-            migration_level = row[0]
-        except Exception:
-            self._initial_setup()
-        finally:
-            if migration_level < latest_migration_version:
-                self._run_migrations(migration_level)
+        # Instances sharing the database may start together, the version is
+        # only read once holding the lock so each step runs exactly once
+        with self._migration_lock():
+            # Try to check the current migration version
+            migration_level = 0
+            try:
+                self._execute("SELECT version FROM migration_version")
+                row = self.cursor.fetchone()
+                migration_level = row[0]
+            except Exception:
+                self._initial_setup()
+            finally:
+                if migration_level < latest_migration_version:
+                    self._run_migrations(migration_level)
 
         logger.info(f"Database initialization of type '{self.db_type}' complete")
 
@@ -65,6 +73,28 @@ class Storage:
 
             return conn
 
+    @contextmanager
+    def _migration_lock(self):
+        """Serialise setup and migrations between instances sharing the database.
+
+        SQLite takes the write lock for a transaction around them, Postgres a
+        session advisory lock.
+        """
+        if self.db_type == "postgres":
+            self._execute("SELECT pg_advisory_lock(?)", (migration_lock_id,))
+            try:
+                yield
+            finally:
+                self._execute("SELECT pg_advisory_unlock(?)", (migration_lock_id,))
+        else:
+            self._execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._execute("ROLLBACK")
+                raise
+            self._execute("COMMIT")
+
     def _initial_setup(self) -> None:
         """Initial setup of the database"""
         logger.info("Performing initial database setup...")
@@ -102,15 +132,246 @@ class Storage:
         """
         logger.debug("Checking for necessary database migrations...")
 
-        # if current_migration_version < 1:
-        #    logger.info("Migrating the database from v0 to v1...")
-        #
-        #    # Add new table, delete old ones, etc.
-        #
-        #    # Update the stored migration version
-        #    self._execute("UPDATE migration_version SET version = 1")
-        #
-        #    logger.info("Database migrated to v1")
+        if current_migration_version < 1:
+            logger.info("Migrating the database from v0 to v1...")
+
+            # Lease shared by the bot instances, the holder is the leader
+            self._execute(
+                """
+                CREATE TABLE leader_lease (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT,
+                    expires_at DOUBLE PRECISION NOT NULL
+                )
+            """
+            )
+            self._execute(
+                """
+                INSERT INTO leader_lease (
+                    name, holder, expires_at
+                ) VALUES (?, ?, ?)
+            """,
+                ("leader", None, 0),
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 1")
+
+            logger.info("Database migrated to v1")
+
+        if current_migration_version < 2:
+            logger.info("Migrating the database from v1 to v2...")
+
+            # Uploads of the library images, so reposts skip encryption and upload.
+            # `file` holds the encrypted attachment info (key, iv, hashes) as JSON
+            self._execute(
+                """
+                CREATE TABLE media_cache (
+                    path TEXT NOT NULL,
+                    encrypted INTEGER NOT NULL,
+                    mtime DOUBLE PRECISION NOT NULL,
+                    size INTEGER NOT NULL,
+                    content_uri TEXT NOT NULL,
+                    file TEXT,
+                    PRIMARY KEY (path, encrypted)
+                )
+            """
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 2")
+
+            logger.info("Database migrated to v2")
+
+        if current_migration_version < 3:
+            logger.info("Migrating the database from v2 to v3...")
+
+            # When the lease was last renewed or released, by the database clock
+            self._execute(
+                "ALTER TABLE leader_lease ADD COLUMN last_renewed_at DOUBLE PRECISION"
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 3")
+
+            logger.info("Database migrated to v3")
+
+        if current_migration_version < 4:
+            logger.info("Migrating the database from v3 to v4...")
+
+            # The last scheduled time each job ran for, so a new leader can
+            # catch up on a run missed during a failover
+            self._execute(
+                """
+                CREATE TABLE job_runs (
+                    name TEXT PRIMARY KEY,
+                    fired_at DOUBLE PRECISION NOT NULL
+                )
+            """
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 4")
+
+            logger.info("Database migrated to v4")
+
+    def _now(self) -> str:
+        """The current unix time as an SQL expression evaluated by the database.
+
+        Lease times are always taken from the database clock, so instances on
+        hosts with skewed clocks still agree on when a lease expires.
+        """
+        if self.db_type == "postgres":
+            return "CAST(EXTRACT(EPOCH FROM now()) AS DOUBLE PRECISION)"
+        return "((julianday('now') - 2440587.5) * 86400.0)"
+
+    def get_lease(self) -> Tuple[Optional[str], Optional[float]]:
+        """Get the last holder of the leader lease and when it last renewed it.
+
+        Returns:
+            A tuple of the holder (None if never held) and the unix timestamp of
+            its last renewal or release, by the database clock.
+        """
+        self._execute(
+            "SELECT holder, last_renewed_at FROM leader_lease WHERE name = ?", ("leader",)
+        )
+        holder, last_renewed_at = self.cursor.fetchone()
+        return holder, last_renewed_at
+
+    def acquire_lease(self, holder: str, duration: float) -> bool:
+        """Take or renew the leader lease.
+
+        The lease is granted if it is already held by `holder` or has expired. The
+        check and the update are a single statement using the database clock, so
+        two instances can never both get it.
+
+        Args:
+            holder: A string identifying the instance asking for the lease.
+            duration: How many seconds the lease is valid for.
+
+        Returns:
+            Whether `holder` now holds the lease.
+        """
+        now = self._now()
+        self._execute(
+            f"""
+            UPDATE leader_lease SET holder = ?, expires_at = {now} + ?, last_renewed_at = {now}
+            WHERE name = ? AND (holder = ? OR holder IS NULL OR expires_at < {now})
+        """,
+            (holder, duration, "leader", holder),
+        )
+        return self.cursor.rowcount == 1
+
+    def release_lease(self, holder: str) -> None:
+        """Give up the leader lease so a standby can take over right away.
+
+        Args:
+            holder: The instance releasing the lease. Nothing happens if it does
+                not hold it.
+        """
+        now = self._now()
+        self._execute(
+            f"""
+            UPDATE leader_lease SET expires_at = 0, last_renewed_at = {now}
+            WHERE name = ? AND holder = ?
+        """,
+            ("leader", holder),
+        )
+
+    def get_last_run(self, name: str) -> Optional[float]:
+        """Get the scheduled time a job last ran for.
+
+        Args:
+            name: The name of the job.
+
+        Returns:
+            The unix timestamp of the scheduled time, or None if it never ran.
+        """
+        self._execute("SELECT fired_at FROM job_runs WHERE name = ?", (name,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def record_run(self, name: str, fired_at: float) -> None:
+        """Remember that a job ran for a scheduled time.
+
+        Args:
+            name: The name of the job.
+            fired_at: The unix timestamp of the scheduled time it ran for.
+        """
+        self._execute(
+            """
+            INSERT INTO job_runs (name, fired_at) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET fired_at = excluded.fired_at
+        """,
+            (name, fired_at),
+        )
+
+    def get_cached_upload(
+        self, path: str, encrypted: bool, mtime: float, size: int
+    ) -> Optional[Tuple[str, Optional[Dict[str, Any]]]]:
+        """Look up an earlier upload of a file.
+
+        Args:
+            path: The path of the uploaded file.
+            encrypted: Whether the upload was encrypted.
+            mtime: The current modification time of the file.
+            size: The current size of the file.
+
+        Returns:
+            The content uri and the encrypted file info (None for plain uploads),
+            or None if the file was never uploaded or has changed since.
+        """
+        self._execute(
+            """
+            SELECT content_uri, file FROM media_cache
+            WHERE path = ? AND encrypted = ? AND mtime = ? AND size = ?
+        """,
+            (path, int(encrypted), mtime, size),
+        )
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+
+        content_uri, file = row
+        return content_uri, json.loads(file) if file else None
+
+    def store_cached_upload(
+        self,
+        path: str,
+        encrypted: bool,
+        mtime: float,
+        size: int,
+        content_uri: str,
+        file: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Remember the upload of a file, replacing any earlier one.
+
+        Args:
+            path: The path of the uploaded file.
+            encrypted: Whether the upload was encrypted.
+            mtime: The modification time of the file when uploaded.
+            size: The size of the file when uploaded.
+            content_uri: The mxc uri of the upload.
+            file: The encrypted file info, without the url.
+        """
+        self._execute(
+            """
+            INSERT INTO media_cache (
+                path, encrypted, mtime, size, content_uri, file
+            ) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path, encrypted) DO UPDATE SET
+                mtime = excluded.mtime, size = excluded.size,
+                content_uri = excluded.content_uri, file = excluded.file
+        """,
+            (
+                path,
+                int(encrypted),
+                mtime,
+                size,
+                content_uri,
+                json.dumps(file) if file else None,
+            ),
+        )
 
     def _execute(self, *args) -> None:
         """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres.